@@ -4,21 +4,57 @@
 View images with bboxes from the COCO dataset.
 """
 import argparse
-import colorsys
-import json
+import hashlib
 import logging
 import os
+import pickle
 import random
+import tempfile
+import threading
+import time
 import tkinter as tk
 import tkinter.ttk as ttk
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from tkinter import filedialog, messagebox
 from turtle import __forwardmethods
 
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont, ImageTk
+from PIL import __version__ as pil_version
+
+# Prefer faster json parsers when available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        from json import loads as json_loads
+
+# Decode JPEGs with libjpeg-turbo directly when available
+try:
+    from turbojpeg import TJPF_RGB, TurboJPEG
+
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    turbo_jpeg = None
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
+# Bump when the layout of the pickled annotations changes, so old cache files are not reused
+ANNOTATIONS_CACHE_VERSION = 2
+
+
+def positive_int(value: str) -> int:
+    """Parses positive integer argument."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive number, got {value}")
+    return number
+
+
 parser = argparse.ArgumentParser(description="View images with bboxes from the COCO dataset")
 parser.add_argument("-i", "--images", default="", type=str, metavar="PATH", help="path to images folder")
 parser.add_argument(
@@ -29,38 +65,84 @@ parser.add_argument(
     metavar="PATH",
     help="path to annotations json file",
 )
+parser.add_argument(
+    "-c",
+    "--cache",
+    nargs="?",
+    const=os.path.join(os.path.expanduser("~"), ".cache", "coco-viewer"),
+    default="",
+    type=str,
+    metavar="PATH",
+    help="cache parsed annotations and decoded images in folder (~/.cache/coco-viewer if PATH is omitted)",
+)
+parser.add_argument(
+    "-p",
+    "--preload",
+    default=1,
+    type=positive_int,
+    metavar="N",
+    help="compose N next images (and the previous one) in the background (default: 1)",
+)
 
 
 class Data:
     """Handles data related stuff."""
 
-    def __init__(self, image_dir, annotations_file):
+    def __init__(self, image_dir, annotations_file, cache_dir="", preload=1):
         self.image_dir = image_dir
-        instances, images, categories = parse_coco(annotations_file)
+        self.cache_dir = cache_dir  # decoded images cache, disabled if empty
+        self.preload = preload  # number of next images composed in the background
+        instances, images, categories, ann_index = parse_coco(annotations_file, cache_dir)
         self.instances = instances
+        self.ann_index = ann_index  # image_id -> list of image annotations
         self.images = ImageList(images)  # NOTE: image list is based on annotations file
         self.categories = categories  # Dataset categories
+        self.color_lut = get_color_lut(categories)  # Mask colors by category id + 1
+
+        # Objects data prepared per image and coloring, recently shown ones are kept
+        self._prepared = LRUCache(size=self.preload + 16)
+
+        # Decoded and composed images caches (shared with the prefetching thread)
+        # NOTE: sized to keep the current image along with the prefetched ones
+        self._decoded = LRUCache(size=self.preload + 2)
+        self._masked = LRUCache(size=self.preload + 3)
+        self._composed = LRUCache(size=self.preload + 7)
+        self._prefetching = set()  # keys of the images being composed in the background
+        self._pool = ThreadPoolExecutor(max_workers=2)
 
         # Prepare the very first image
         self.current_image = self.images.next()  # Set the first image as current
 
-    def prepare_image(self, object_based_coloring: bool = False):
+    def prepare_image(self, object_based_coloring: bool = False, image: tuple = None):
         """Prepares image path, objects, colors."""
         # TODO: predicted bboxes drawing (from models)
-        img_id, img_name = self.current_image
+        img_id, img_name = image or self.current_image
         full_path = os.path.join(self.image_dir, img_name)
 
+        # Annotations are static, so prepare them only once
+        key = (img_id, object_based_coloring)
+        prepared = self._prepared.get(key)
+        if prepared is None:
+            prepared = self.prepare_objects(img_id, object_based_coloring)
+            self._prepared.put(key, prepared)
+        return (full_path, *prepared)
+
+    def prepare_objects(self, img_id: int, object_based_coloring: bool = False):
+        """Prepares masks, bboxes, colors."""
         # Get objects and category ids
-        objects = [obj for obj in self.instances["annotations"] if obj["image_id"] == img_id]
-        obj_categories_ids = [obj["category_id"] for obj in objects]
+        objects = self.ann_index.get(img_id, [])
+        obj_categories_ids = np.array([obj["category_id"] for obj in objects], dtype=np.int64)
 
         # List of category ids of all objects
-        img_obj_categories = [obj["category_id"] for obj in objects]
+        img_obj_categories = obj_categories_ids.tolist()
         # Current image categories (unique sorted category ids)
-        img_categories = sorted(list(set(img_obj_categories)))
+        img_categories = np.unique(obj_categories_ids).tolist()
 
         # Get category name-color pairs for the objects
-        names_colors = [self.categories[i] for i in obj_categories_ids]
+        names_colors = [self.categories[i] for i in img_obj_categories]
+
+        # Mask color indices (0 is for the background) and their palette
+        mask_colors = ((obj_categories_ids + 1).tolist(), self.color_lut)
 
         # Objects based coloring (instances)
         if object_based_coloring:
@@ -74,8 +156,85 @@ class Data:
                 names_colors_obj.append([names_colors[i][0], obj_colors[i]])
 
             names_colors = names_colors_obj
-
-        return full_path, objects, names_colors, img_obj_categories, img_categories
+            mask_colors = (list(range(1, len(objects) + 1)), np.array([(0, 0, 0), *obj_colors], dtype=np.uint8))
+
+        # Bbox corners and masks for drawing
+        bboxes = get_bboxes(objects)
+        masks = get_masks(objects)
+
+        return masks, bboxes, names_colors, mask_colors, img_obj_categories, img_categories
+
+    def compose_image(self, image: tuple = None, coloring: bool = False, max_size: tuple = None, **params):
+        """Composes image (the current one by default), reuses cached results.
+
+        Images larger than max_size are shrunk to fit it before drawing.
+        """
+        image = image or self.current_image
+        key = self._compose_key(image, coloring, max_size, params)
+        composed = self._composed.get(key)
+        if composed is not None:
+            return composed
+
+        # Masks are blended once for any bboxes and labels settings
+        mask_params = {name: value for name, value in params.items() if name in ("masks_on", "ignore", "alpha")}
+        draw_params = {name: value for name, value in params.items() if name not in ("masks_on", "alpha")}
+        masked, scale = self.mask_image(image, coloring, max_size, **mask_params)
+        _, _, bboxes, names_colors, _, _, _ = self.prepare_image(coloring, image)
+        composed = draw_objects(masked, bboxes, names_colors, scale=scale, **draw_params)
+        self._composed.put(key, composed)
+        return composed
+
+    def mask_image(self, image: tuple, coloring: bool = False, max_size: tuple = None, **params):
+        """Blends masks into the image, returns it with the scale factors, reuses cached results."""
+        key = self._compose_key(image, coloring, max_size, params)
+        masked = self._masked.get(key)
+        if masked is None:
+            full_path, masks, _, _, mask_colors, _, _ = self.prepare_image(coloring, image)
+            img_open, scale = self.open_image(full_path, max_size)
+            masked = blend_masks(img_open, masks, mask_colors, scale=scale, **params), scale
+            self._masked.put(key, masked)
+        return masked
+
+    @staticmethod
+    def _compose_key(image: tuple, coloring: bool, max_size: tuple, params: dict) -> tuple:
+        return image[0], coloring, max_size, tuple(sorted(params.items()))
+
+    def open_image(self, full_path: str, max_size: tuple = None):
+        """Opens image shrunk to max size, returns it with the scale factors.
+
+        Recently opened images are kept, so redraws skip decoding.
+        """
+        key = (full_path, max_size)
+        opened = self._decoded.get(key)
+        if opened is None:
+            opened = open_image(full_path, self.cache_dir, max_size)
+            self._decoded.put(key, opened)
+        return opened
+
+    def prefetch(self, coloring: bool = False, max_size: tuple = None, **params) -> list:
+        """Composes the next (preload many) and the previous images in the background.
+
+        Returns (image, future) pairs of the submitted images, futures result in composed images.
+        """
+        prefetched = []
+        for offset in (1, -1, *range(2, self.preload + 1)):
+            image = self.images.peek(offset)
+            key = self._compose_key(image, coloring, max_size, params)
+            # Skip images which are already composed or on their way
+            if key in self._prefetching or self._composed.get(key) is not None:
+                continue
+            self._prefetching.add(key)
+            prefetched.append((image, self._pool.submit(self._prefetch, image, key, coloring, max_size, **params)))
+        return prefetched
+
+    def _prefetch(self, image: tuple, key: tuple, coloring: bool, max_size: tuple, **params):
+        try:
+            return self.compose_image(image, coloring, max_size, **params)
+        except Exception as e:
+            # Leave it to the UI to report broken images and annotations once the image is shown
+            logging.debug(f"Prefetching {image[-1]} failed: {e!r}")
+        finally:
+            self._prefetching.discard(key)
 
     def next_image(self):
         """Loads the next image in a list."""
@@ -86,20 +245,65 @@ class Data:
         self.current_image = self.images.prev()
 
 
-def parse_coco(annotations_file: str) -> tuple:
-    """Parses COCO json annotation file."""
+def parse_coco(annotations_file: str, cache_dir: str = "") -> tuple:
+    """Parses COCO json annotation file, reuses the parsed copy from the cache folder if any.
+
+    Cached annotations are pickled per image and unpickled only when the image is shown.
+    """
+    if cache_dir:
+        cache_file = get_cache_file(cache_dir, annotations_file, ".pkl", version=ANNOTATIONS_CACHE_VERSION)
+        try:
+            with open(cache_file, "rb") as f:
+                logging.info(f"Loading parsed {annotations_file} from cache...")
+                instances, images, categories, ann_blobs = pickle.load(f)
+            return instances, images, categories, PickledIndex(ann_blobs)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+
     instances = load_annotations(annotations_file)
     images = get_images(instances)
     categories = get_categories(instances)
-    return instances, images, categories
+    ann_index = get_annotations_index(instances)
+    # Annotations are reachable through the index only, drop the list to free memory
+    instances.pop("annotations", None)
+
+    if cache_dir:
+        ann_blobs = {img_id: pickle.dumps(objs, protocol=pickle.HIGHEST_PROTOCOL) for img_id, objs in ann_index.items()}
+        cached = instances, images, categories, ann_blobs
+        save_to_cache(cache_file, lambda f: pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL))
+    return instances, images, categories, ann_index
+
+
+def get_cache_file(cache_dir: str, fname: str, ext: str, version: int = 1) -> str:
+    """Returns cache file path bound to the file path, its modification time and size, and the cache format version."""
+    stat = os.stat(fname)
+    key = f"{os.path.abspath(fname)}:{stat.st_mtime_ns}:{stat.st_size}"
+    if version > 1:
+        key += f":v{version}"
+    return os.path.join(cache_dir, f"{hashlib.sha1(key.encode()).hexdigest()}{ext}")
+
+
+def save_to_cache(cache_file: str, save):
+    """Saves cache file, save is called with the file object to write to."""
+    cache_dir = os.path.dirname(cache_file)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first, so readers never see a partial file
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp", delete=False) as f:
+            save(f)
+        os.replace(f.name, cache_file)
+    except OSError as e:
+        logging.warning(f"Could not write cache {cache_file}: {e}")
 
 
 def load_annotations(fname: str) -> dict:
     """Loads annotations file."""
     logging.info(f"Parsing {fname}...")
+    started = time.monotonic()
 
-    with open(fname) as f:
-        instances = json.load(f)
+    with open(fname, "rb") as f:
+        instances = json_loads(f.read())
+    logging.info(f"Parsed {fname} in {time.monotonic() - started:.1f}s")
     return instances
 
 
@@ -108,165 +312,361 @@ def get_images(instances: dict) -> list:
     return [(image["id"], image["file_name"]) for image in instances["images"]]
 
 
-def open_image(full_img_path: str):
-    """Opens image, creates draw context."""
-    # Open image
-    img_open = Image.open(full_img_path).convert("RGBA")
-    # Create layer for bboxes and masks
-    draw_layer = Image.new("RGBA", img_open.size, (255, 255, 255, 0))
-    draw = ImageDraw.Draw(draw_layer)
-    return img_open, draw_layer, draw
-
+def get_annotations_index(instances: dict) -> dict:
+    """Groups annotations by image id."""
+    ann_index = {}
+    for obj in instances["annotations"]:
+        ann_index.setdefault(obj["image_id"], []).append(obj)
+    return ann_index
 
-def prepare_colors(n_objects: int, shuffle: bool = True) -> list:
-    """Get some colors."""
-    # Get some colors
-    hsv_tuples = [(x / n_objects, 1.0, 1.0) for x in range(n_objects)]
-    colors = list(map(lambda x: colorsys.hsv_to_rgb(*x), hsv_tuples))
-    colors = list(map(lambda x: (int(x[0] * 255), int(x[1] * 255), int(x[2] * 255)), colors))
 
-    # Shuffle colors
+def get_masks(objects: list) -> list:
+    """Extracts objects masks: lists of (N, 2) polygon arrays, RLE dicts (iscrowd=1) or None."""
+    masks = []
+    for obj in objects:
+        m = obj["segmentation"]
+        if isinstance(m, list):
+            masks.append([np.array(poly, dtype=np.float64).reshape(-1, 2) for poly in m if poly])
+        elif isinstance(m, dict) and obj["iscrowd"]:
+            masks.append(m)
+        else:
+            masks.append(None)
+    return masks
+
+
+def get_bboxes(objects: list) -> np.ndarray:
+    """Converts objects bboxes from [x, y, w, h] to [x0, y0, x1, y1], returns (N, 4) array."""
+    bboxes = np.array([obj["bbox"] for obj in objects], dtype=np.float32).reshape(-1, 4)
+    bboxes[:, 2:] += bboxes[:, :2]
+    return bboxes
+
+
+def decode_image(full_img_path: str, max_size: tuple = None) -> tuple:
+    """Decodes image file into RGB image, returns it with the original image size.
+
+    JPEGs are decoded at 1/2, 1/4 or 1/8 scale, if the result still covers max_size.
+    """
+    if turbo_jpeg is not None and full_img_path.lower().endswith((".jpg", ".jpeg")):
+        with open(full_img_path, "rb") as f:
+            data = f.read()
+        try:
+            width, height, _, _ = turbo_jpeg.decode_header(data)
+            scaling_factor = get_jpeg_scaling_factor((width, height), max_size)
+            img_arr = turbo_jpeg.decode(data, pixel_format=TJPF_RGB, scaling_factor=scaling_factor)
+            return Image.fromarray(img_arr, "RGB"), (width, height)
+        except OSError:
+            pass  # Unsupported by libjpeg-turbo (e.g. CMYK), let PIL handle it
+    img_open = Image.open(full_img_path)
+    size = img_open.size
+    if max_size:
+        img_open.draft("RGB", max_size)  # NOTE: does nothing for non JPEG images
+    return img_open.convert("RGB"), size
+
+
+def get_jpeg_scaling_factor(size: tuple, max_size: tuple = None):
+    """Returns the smallest JPEG decoding scale which still covers max_size, None for the full scale."""
+    if max_size:
+        scale = min(size[0] // max_size[0], size[1] // max_size[1])
+        for denominator in (8, 4, 2):
+            if scale >= denominator:
+                return 1, denominator
+    return None
+
+
+def open_image(full_img_path: str, cache_dir: str = "", max_size: tuple = None) -> tuple:
+    """Opens image shrunk to fit max_size, returns it with the scale factors.
+
+    Decoded copies are reused from the cache folder if any, they are kept at full size.
+    """
+    if cache_dir:
+        img_open = open_cached_image(full_img_path, cache_dir)
+        size = img_open.size
+    else:
+        img_open, size = decode_image(full_img_path, max_size)
+
+    if max_size and (img_open.width > max_size[0] or img_open.height > max_size[1]):
+        img_open = img_open.copy()  # NOTE: decoded image may be read-only
+        img_open.thumbnail(max_size, Image.Resampling.BILINEAR)
+    scale = (img_open.width / size[0], img_open.height / size[1])
+    return img_open, scale
+
+
+def open_cached_image(full_img_path: str, cache_dir: str):
+    """Opens image from the cache folder, decodes and caches it if missing."""
+    cache_file = get_cache_file(cache_dir, full_img_path, ".npy")
+    try:
+        img_arr = np.load(cache_file, mmap_mode="r")
+        if img_arr.ndim == 3 and img_arr.shape[-1] == 3:
+            return Image.fromarray(img_arr, "RGB")
+    except (OSError, ValueError):
+        pass
+
+    img_open, _ = decode_image(full_img_path)
+    save_to_cache(cache_file, lambda f: np.save(f, np.asarray(img_open)))
+    return img_open
+
+
+@lru_cache(maxsize=None)
+def prepare_colors(n_objects: int, shuffle: bool = True) -> tuple:
+    """Get some colors, results are cached as they depend on the arguments only."""
+    # Evenly spaced hues at full saturation and value (same math as colorsys.hsv_to_rgb)
+    h = np.arange(n_objects) / n_objects * 6.0
+    i = h.astype(int)
+    f = h - i
+    v, p, q, t = np.ones_like(h), np.zeros_like(h), 1.0 - f, 1.0 - (1.0 - f)
+    i %= 6
+    r = np.choose(i, [v, q, p, p, t, v])
+    g = np.choose(i, [t, v, v, q, p, p])
+    b = np.choose(i, [p, p, t, v, v, q])
+    colors = list(map(tuple, (np.stack([r, g, b], axis=1) * 255).astype(int).tolist()))
+
+    # Shuffle colors (local generator, safe to call from the prefetching thread)
     if shuffle:
-        random.seed(42)
-        random.shuffle(colors)
-        random.seed(None)
+        random.Random(42).shuffle(colors)
 
-    return colors
+    return tuple(colors)
 
 
-def get_categories(instances: dict) -> dict:
-    """Extracts categories from annotations file and prepares color for each one."""
-    # Parse categories
-    colors = prepare_colors(n_objects=80, shuffle=True)
-    categories = list(
-        zip(
-            [[category["id"], category["name"]] for category in instances["categories"]],
-            colors,
-        )
-    )
-    categories = dict([[cat[0][0], [cat[0][1], cat[1]]] for cat in categories])
+def get_categories(instances: dict) -> list:
+    """Extracts categories from annotations file and prepares color for each one.
+
+    Returns [name, color] pairs indexed by category id, unused ids are None.
+    """
+    # Parse categories (at least 80 colors, so COCO categories keep their colors)
+    colors = prepare_colors(n_objects=max(80, len(instances["categories"])), shuffle=True)
+    categories = [None] * (max((category["id"] for category in instances["categories"]), default=-1) + 1)
+    for category, color in zip(instances["categories"], colors):
+        categories[category["id"]] = [category["name"], color]
     return categories
 
 
-def draw_bboxes(draw, objects, labels, obj_categories, ignore, width, label_size):
+def get_color_lut(categories: list) -> np.ndarray:
+    """Builds color lookup table indexed by category id + 1, row 0 is left for the background."""
+    color_lut = np.zeros((len(categories) + 1, 3), dtype=np.uint8)
+    for category_id, category in enumerate(categories):
+        if category is not None:
+            color_lut[category_id + 1] = category[1]
+    return color_lut
+
+
+def compose_image(
+    img_open,
+    masks,
+    bboxes,
+    names_colors,
+    mask_colors,
+    bboxes_on: bool = True,
+    labels_on: bool = True,
+    masks_on: bool = True,
+    ignore: frozenset = frozenset(),
+    width: int = 1,
+    alpha: int = 128,
+    label_size: int = 15,
+    scale: tuple = (1.0, 1.0),
+):
+    """Draws objects over the image, returns composed image.
+
+    Objects coordinates are multiplied by scale, if the image was resized.
+    """
+    masked = blend_masks(img_open, masks, mask_colors, masks_on, ignore, alpha, scale)
+    return draw_objects(masked, bboxes, names_colors, bboxes_on, labels_on, ignore, width, label_size, scale)
+
+
+def blend_masks(
+    img_open,
+    masks,
+    mask_colors,
+    masks_on: bool = True,
+    ignore: frozenset = frozenset(),
+    alpha: int = 128,
+    scale: tuple = (1.0, 1.0),
+):
+    """Blends masks into a copy of the image, returns the image itself if there is nothing to blend."""
+    if not masks_on or len(ignore) >= len(masks):
+        return img_open
+    img_arr = np.array(img_open)
+    draw_masks(img_arr, masks, mask_colors, ignore, alpha, scale)
+    return Image.fromarray(img_arr, "RGB")
+
+
+def draw_objects(
+    img,
+    bboxes,
+    names_colors,
+    bboxes_on: bool = True,
+    labels_on: bool = True,
+    ignore: frozenset = frozenset(),
+    width: int = 1,
+    label_size: int = 15,
+    scale: tuple = (1.0, 1.0),
+):
+    """Draws bboxes and labels on a copy of the image, returns the image itself if bboxes are off."""
+    if not bboxes_on:
+        return img  # Nothing to draw, show the image as is
+    if scale != (1.0, 1.0):
+        sx, sy = scale
+        bboxes = bboxes * np.array([sx, sy, sx, sy], dtype=np.float32)
+    # Bboxes and labels are opaque, draw them right on the image
+    composed = img.copy()
+    draw = ImageDraw.Draw(composed)
+    draw_bboxes(draw, bboxes.tolist(), labels_on, names_colors, ignore, width, label_size)
+    del draw
+    return composed
+
+
+@lru_cache(maxsize=32)
+def get_font(size: int):
+    """Loads labels font of the size, fonts are cached as loading them is slow."""
+    try:
+        try:
+            # Should work for Linux
+            return ImageFont.truetype("DejaVuSans.ttf", size=size)
+        except OSError:
+            # Should work for Windows
+            return ImageFont.truetype("Arial.ttf", size=size)
+    except OSError:
+        # Load default, note no resize option
+        # TODO: Implement notification message as popup window
+        return ImageFont.load_default()
+
+
+def draw_bboxes(draw, bboxes, labels, obj_categories, ignore, width, label_size):
     """Puts rectangles on the image."""
-    # Extracting bbox coordinates
-    bboxes = [
-        [
-            obj["bbox"][0],
-            obj["bbox"][1],
-            obj["bbox"][0] + obj["bbox"][2],
-            obj["bbox"][1] + obj["bbox"][3],
-        ]
-        for obj in objects
-    ]
+    rectangle = draw.rectangle  # NOTE: called per object, resolve the method once
+    font = get_font(label_size) if labels else None
+    img_width = draw.im.size[0]
     # Draw bboxes
     for i, (c, b) in enumerate(zip(obj_categories, bboxes)):
         if i not in ignore:
-            draw.rectangle(b, outline=c[-1], width=width)
+            rectangle(b, outline=c[-1], width=width)
 
             if labels:
                 text = c[0]
-
-                try:
-                    try:
-                        # Should work for Linux
-                        font = ImageFont.truetype("DejaVuSans.ttf", size=label_size)
-                    except OSError:
-                        # Should work for Windows
-                        font = ImageFont.truetype("Arial.ttf", size=label_size)
-                except OSError:
-                    # Load default, note no resize option
-                    # TODO: Implement notification message as popup window
-                    font = ImageFont.load_default()
-
-                tw, th = draw.textsize(text, font)
-                tx0 = b[0]
-                ty0 = b[1] - th
-
-                # TODO: Looks weird! We need image dims to make it right
-                tx0 = max(b[0], max(b[0], tx0)) if tx0 < 0 else tx0
-                ty0 = max(b[1], max(0, ty0)) if ty0 < 0 else ty0
-
-                tx1 = tx0 + tw
-                ty1 = ty0 + th
-
-                # TODO: The same here
-                if tx1 > b[2]:
-                    tx0 = max(0, tx0 - (tx1 - b[2]))
-                    tx1 = tw if tx0 == 0 else b[2]
-
-                draw.rectangle((tx0, ty0, tx1, ty1), fill=c[-1])
-                draw.text((tx0, ty0), text, (255, 255, 255), font=font)
-
-
-def draw_masks(draw, objects, obj_categories, ignore, alpha):
-    """Draws a masks over image."""
-    masks = [obj["segmentation"] for obj in objects]
-    # Draw masks
-    for i, (c, m) in enumerate(zip(obj_categories, masks)):
+                _, _, tw, th = font.getbbox(text, anchor="la")
+                # Label goes above the bbox, inside it if there is no room, and stays within the image
+                tx0 = max(0, min(b[0], img_width - tw))
+                ty0 = b[1] - th if b[1] >= th else b[1]
+                rectangle((tx0, ty0, tx0 + tw, ty0 + th), fill=c[-1])
+                draw.text((tx0, ty0), text, (255, 255, 255), font=font, anchor="la")
+
+
+def draw_masks(img_arr, masks, mask_colors, ignore, alpha, scale=(1.0, 1.0)):
+    """Blends masks into the image array."""
+    color_ids, palette = mask_colors
+
+    # Rasterize all masks into a single layer of palette indices
+    index_layer = Image.new("L" if len(palette) <= 256 else "I", img_arr.shape[1::-1], 0)
+    draw = ImageDraw.Draw(index_layer)
+    polygon = draw.polygon  # NOTE: called per polygon, resolve the method once
+    scale_xy = np.array(scale) if scale != (1.0, 1.0) else None
+    for i, (fill, m) in enumerate(zip(color_ids, masks)):
         if i not in ignore:
-            alpha = alpha
-            fill = tuple(list(c[-1]) + [alpha])
             # Polygonal masks work fine
             if isinstance(m, list):
                 for m_ in m:
-                    if m_:
-                        draw.polygon(m_, outline=fill, fill=fill)
+                    if scale_xy is not None:
+                        m_ = m_ * scale_xy
+                    polygon(m_.ravel().tolist(), outline=fill, fill=fill)
             # RLE mask for collection of objects (iscrowd=1)
-            elif isinstance(m, dict) and objects[i]["iscrowd"]:
-                mask = rle_to_mask(m["counts"][:-1], m["size"][0], m["size"][1])
+            elif isinstance(m, dict):
+                mask = rle_to_mask(m["counts"], m["size"][0], m["size"][1])
                 mask = Image.fromarray(mask)
+                if mask.size != index_layer.size:
+                    mask = mask.resize(index_layer.size, Image.Resampling.NEAREST)
                 draw.bitmap((0, 0), mask, fill=fill)
 
             else:
                 continue
 
+    # Only the region covered by masks needs blending
+    box = index_layer.getbbox()
+    if box is None:
+        return
+    x0, y0, x1, y1 = box
+    index_arr = np.asarray(index_layer.crop(box))
+    region = img_arr[y0:y1, x0:x1]
+
+    # Blend colors into the touched pixels only, integer math with rounding (fits uint16)
+    touched = index_arr != 0
+    a = np.uint16(alpha)
+    src = palette[index_arr[touched]].astype(np.uint16)
+    dst = region[touched].astype(np.uint16)
+    region[touched] = (src * a + dst * (255 - a) + 127) // 255
+
 
 def rle_to_mask(rle, height, width):
+    """Decodes uncompressed RLE (alternating background/object runs) into a mask."""
     rows, cols = height, width
-    rle_pairs = np.array(rle).reshape(-1, 2)
+    # Expand all runs at once
+    values = np.zeros(len(rle), dtype=np.uint8)
+    values[1::2] = 255
+    runs = np.repeat(values, rle)[: rows * cols]
     img = np.zeros(rows * cols, dtype=np.uint8)
-    index_offset = 0
-
-    for index, length in rle_pairs:
-        index_offset += index
-        img[index_offset : index_offset + length] = 255
-        index_offset += length
+    img[: len(runs)] = runs
 
     img = img.reshape(cols, rows)
     img = img.T
     return img
 
 
+class LRUCache:
+    """Thread-safe cache that keeps the most recently used items."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns cached item or None."""
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+            return item
+
+    def put(self, key, item):
+        """Caches item, drops the least recently used ones if full."""
+        with self._lock:
+            self._items[key] = item
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+
+class PickledIndex:
+    """Read-only mapping of pickled values, unpickles them on access."""
+
+    def __init__(self, blobs: dict):
+        self._blobs = blobs
+
+    def get(self, key, default=None):
+        """Returns unpickled value or default."""
+        blob = self._blobs.get(key)
+        return default if blob is None else pickle.loads(blob)
+
+
 class ImageList:
     """Handles iterating through the images."""
 
     def __init__(self, images: list):
-        self.image_list = images or []
+        self.image_list = tuple(images or ())
         self.n = -1
         self.max = len(self.image_list)
 
     def next(self):
         """Sets the next image as current."""
-        self.n += 1
-
-        if self.n < self.max:
-            current_image = self.image_list[self.n]
-        else:
-            self.n = 0
-            current_image = self.image_list[self.n]
-        return current_image
+        self.n = (self.n + 1) % self.max
+        return self.image_list[self.n]
 
     def prev(self):
         """Sets the previous image as current."""
-        if self.n == 0:
-            self.n = self.max - 1
-            current_image = self.image_list[self.n]
-        else:
-            self.n -= 1
-            current_image = self.image_list[self.n]
-        return current_image
+        self.n = (self.n - 1) % self.max
+        return self.image_list[self.n]
+
+    def peek(self, offset: int):
+        """Returns the image at the offset from the current one."""
+        return self.image_list[(self.n + offset) % self.max]
 
 
 class ImagePanel(ttk.Frame):
@@ -574,14 +974,23 @@ class Controller:
         self.label_size.set(15)
         self.mask_alpha = tk.IntVar()
         self.mask_alpha.set(128)
-        self.sliders.bbox_slider.configure(variable=self.bbox_thickness, command=lambda e: self.update_img())
-        self.sliders.label_slider.configure(variable=self.label_size, command=lambda e: self.update_img())
-        self.sliders.mask_slider.configure(variable=self.mask_alpha, command=lambda e: self.update_img())
+        self.pending_update = None  # scheduled slider update
+        self.sliders.bbox_slider.configure(variable=self.bbox_thickness, command=self.schedule_update_img)
+        self.sliders.label_slider.configure(variable=self.label_size, command=self.schedule_update_img)
+        self.sliders.mask_slider.configure(variable=self.mask_alpha, command=self.schedule_update_img)
 
         # Bind all events
         self.bind_events()
 
+        # Larger images are shrunk to the screen size for display
+        self.max_size = (self.root.winfo_screenwidth(), self.root.winfo_screenheight())
+
+        # Tk images of recently shown compositions (Tk thread only)
+        self.photo_cache = LRUCache(size=self.data.preload + 15)
+        self.image_item = None  # canvas item showing the current image
+
         # Compose the very first image
+        self.current_compose_params = None
         self.current_composed_image = None
         self.current_img_obj_categories = None
         self.current_img_categories = None
@@ -596,31 +1005,6 @@ class Controller:
         # Update sliders
         self.update_sliders_state()
 
-    def compose_image(
-        self,
-        full_path,
-        objects,
-        names_colors,
-        bboxes_on: bool = True,
-        labels_on: bool = True,
-        masks_on: bool = True,
-        ignore: list = None,
-        width: int = 1,
-        alpha: int = 128,
-        label_size: int = 15,
-    ):
-        ignore = ignore or []  # list of objects to ignore
-        img_open, draw_layer, draw = open_image(full_path)
-        # Draw masks
-        if masks_on:
-            draw_masks(draw, objects, names_colors, ignore, alpha)
-        # Draw bounding boxes
-        if bboxes_on:
-            draw_bboxes(draw, objects, labels_on, names_colors, ignore, width, label_size)
-        del draw
-        # Resulting image
-        self.current_composed_image = Image.alpha_composite(img_open, draw_layer)
-
     def update_img(self, local=True, width=None, alpha=None, label_size=None):
         """Triggers image composition and sets composed image as current."""
         bboxes_on = self.bboxes_on_local if local else self.bboxes_on_global.get()
@@ -629,30 +1013,23 @@ class Controller:
         coloring = self.coloring_on_local if local else self.coloring_on_global.get()
 
         # Prepare image
-        (
-            full_path,
-            objects,
-            names_colors,
-            img_obj_categories,
-            img_categories,
-        ) = self.data.prepare_image(coloring)
+        *_, img_obj_categories, img_categories = self.data.prepare_image(coloring)
         self.current_img_obj_categories = img_obj_categories
         self.current_img_categories = img_categories
 
+        # Objects to hide, a set for constant time membership tests while drawing
         if self.selected_objs is None:
-            ignore = []
+            ignore = frozenset()
         else:
-            ignore = [i for i in range(len(self.current_img_obj_categories)) if i not in self.selected_objs]
+            ignore = frozenset(range(len(self.current_img_obj_categories))).difference(self.selected_objs)
 
         width = self.bbox_thickness.get() if width is None else width
         alpha = self.mask_alpha.get() if alpha is None else alpha
         label_size = self.label_size.get() if label_size is None else label_size
 
         # Compose image
-        self.compose_image(
-            full_path=full_path,
-            objects=objects,
-            names_colors=names_colors,
+        self.current_compose_params = dict(
+            coloring=coloring,
             bboxes_on=bboxes_on,
             labels_on=labels_on,
             masks_on=masks_on,
@@ -661,14 +1038,21 @@ class Controller:
             alpha=alpha,
             label_size=label_size,
         )
-
-        # Prepare PIL image for Tkinter
-        img = self.current_composed_image
-        w, h = img.size
-        img = ImageTk.PhotoImage(img)
-
-        # Set image as current
-        self.image_panel.create_image(0, 0, image=img)
+        self.current_composed_image = self.data.compose_image(max_size=self.max_size, **self.current_compose_params)
+
+        # Prepare PIL image for Tkinter, unless it is already there
+        key = (self.data.current_image[0], tuple(sorted(self.current_compose_params.items())))
+        img = self.photo_cache.get(key)
+        if img is None:
+            img = ImageTk.PhotoImage(self.current_composed_image)
+            self.photo_cache.put(key, img)
+        w, h = img.width(), img.height()
+
+        # Set image as current, reusing the canvas item
+        if self.image_item is None:
+            self.image_item = self.image_panel.create_image(0, 0, image=img)
+        else:
+            self.image_panel.itemconfigure(self.image_item, image=img)
         self.image_panel.image = img
         self.image_panel.reset(canvwidth=w, canvheight=h)
 
@@ -683,6 +1067,45 @@ class Controller:
         self.update_category_box()
         self.update_object_box()
 
+        # Compose neighbours the way navigation will show them
+        prefetch_params = dict(
+            coloring=self.coloring_on_global.get(),
+            bboxes_on=self.bboxes_on_global.get(),
+            labels_on=self.labels_on_global.get(),
+            masks_on=self.masks_on_global.get(),
+            ignore=frozenset(),
+            width=width,
+            alpha=alpha,
+            label_size=label_size,
+        )
+        prefetched = self.data.prefetch(max_size=self.max_size, **prefetch_params)
+        if prefetched:
+            self.root.after(20, self.prepare_photos, prefetched, prefetch_params)
+
+    def prepare_photos(self, prefetched: list, params: dict):
+        """Prepares PIL images for Tkinter once they are composed in the background."""
+        pending = []
+        for image, future in prefetched:
+            if not future.done():
+                pending.append((image, future))
+            elif future.result() is not None:
+                # NOTE: PhotoImage has to be created in the main thread
+                key = (image[0], tuple(sorted(params.items())))
+                if self.photo_cache.get(key) is None:
+                    self.photo_cache.put(key, ImageTk.PhotoImage(future.result()))
+        if pending:
+            self.root.after(20, self.prepare_photos, pending, params)
+
+    def schedule_update_img(self, event=None):
+        """Coalesces frequent updates (e.g. slider drags), only the last one within 30 ms is drawn."""
+        if self.pending_update is not None:
+            self.root.after_cancel(self.pending_update)
+        self.pending_update = self.root.after(30, self.run_scheduled_update)
+
+    def run_scheduled_update(self):
+        self.pending_update = None
+        self.update_img()
+
     def exit(self, event=None):
         print_info("Exiting...")
         self.root.quit()
@@ -702,11 +1125,11 @@ class Controller:
         self.update_img(local=False)
 
     def save_image(self, event=None):
-        """Saves composed image as png file."""
+        """Saves composed image as png or jpg file."""
         # Initial (original) file name
         initialfile = self.data.current_image[-1].split(".")[0]
-        # TODO: Add more formats, at least jpg (RGBA -> RGB)?
-        filetypes = (("png files", "*.png"), ("all files", "*.*"))
+        # Composed images are RGB, so they can be saved as jpg as is
+        filetypes = (("png files", "*.png"), ("jpg files", "*.jpg *.jpeg"), ("all files", "*.*"))
         # By default save as png file
         defaultextension = ".png"
         file = filedialog.asksaveasfilename(
@@ -714,9 +1137,9 @@ class Controller:
             filetypes=filetypes,
             defaultextension=defaultextension,
         )
-        # If not canceled:
+        # If not canceled, save in the original size
         if file:
-            self.current_composed_image.save(file)
+            self.data.compose_image(**self.current_compose_params).save(file)
 
     def menu_view_bboxes(self):
         self.bboxes_on_local = self.bboxes_on_global.get()
@@ -792,12 +1215,10 @@ class Controller:
         # Set selected_cats
         self.selected_cats = selected_ids
         # Set selected_objs
-        selected_objs = []
-        for ci in self.selected_cats:
-            for i, o in enumerate(self.current_img_obj_categories):
-                if self.current_img_categories[ci] == o:
-                    selected_objs.append(i)
-        self.selected_objs = selected_objs
+        cat_objs = {}
+        for i, c in enumerate(self.current_img_obj_categories):
+            cat_objs.setdefault(c, []).append(i)
+        self.selected_objs = [i for ci in self.selected_cats for i in cat_objs[self.current_img_categories[ci]]]
         self.update_img()
 
     def update_object_box(self):
@@ -817,12 +1238,8 @@ class Controller:
         # Set selected_cats
         self.selected_objs = selected_ids
         # Set selected_objs
-        selected_cats = []
-        for oi in self.selected_objs:
-            for i, c in enumerate(self.current_img_categories):
-                if self.current_img_obj_categories[oi] == c:
-                    selected_cats.append(i)
-        self.selected_cats = selected_cats
+        cat_positions = {c: i for i, c in enumerate(self.current_img_categories)}
+        self.selected_cats = [cat_positions[self.current_img_obj_categories[oi]] for oi in self.selected_objs]
         self.update_img()
 
     def update_sliders_state(self):
@@ -871,9 +1288,30 @@ def print_info(message: str):
     logging.info(message)
 
 
+def run_in_background(func, *args) -> Future:
+    """Calls function in a daemon thread, returns future for its result."""
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
 def main():
     print_info("Starting...")
+    # Pillow-SIMD versions look like 9.0.0.post1
+    if ".post" in pil_version:
+        print_info(f"Using Pillow-SIMD {pil_version}")
     args = parser.parse_args()
+    if args.images and args.annotations:
+        # Load dataset in the background, so it overlaps with creating the window
+        # NOTE: json parsing holds the GIL, so the window freezes until the parsing is done
+        loading = run_in_background(Data, args.images, args.annotations, args.cache, args.preload)
     root = tk.Tk()
     root.title("COCO Viewer")
 
@@ -884,13 +1322,28 @@ def main():
         root.destroy()
         return
 
-    data = Data(args.images, args.annotations)
     statusbar = StatusBar(root)
-    sliders = SlidersBar(root)
-    objects_panel = ObjectsPanel(root)
-    menu = Menu(root)
-    image_panel = ImagePanel(root)
-    Controller(data, root, image_panel, statusbar, menu, objects_panel, sliders)
+    statusbar.file_name.configure(text=f"Loading {os.path.basename(args.annotations)}...")
+
+    def start_when_loaded():
+        if not loading.done():
+            root.after(100, start_when_loaded)
+            return
+        try:
+            data = loading.result()
+        except Exception as e:
+            logging.error(f"Could not load the dataset: {e}")
+            messagebox.showerror("Error!", f"Could not load the dataset:\n{e}")
+            root.destroy()
+            return
+
+        sliders = SlidersBar(root)
+        objects_panel = ObjectsPanel(root)
+        menu = Menu(root)
+        image_panel = ImagePanel(root)
+        Controller(data, root, image_panel, statusbar, menu, objects_panel, sliders)
+
+    start_when_loaded()
     root.mainloop()
 
 
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Profiles image composition on the most crowded images of the dataset.
+
+Example:
+    python scripts/profile_compose.py -i coco/images/val2017 -a coco/annotations/instances_val2017.json
+    snakeviz profile_output.prof
+"""
+import argparse
+import cProfile
+import os
+import pstats
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cocoviewer import Data, compose_image, open_image  # noqa: E402
+
+parser = argparse.ArgumentParser(description="Profile image composition with cProfile")
+parser.add_argument("-i", "--images", required=True, type=str, metavar="PATH", help="path to images folder")
+parser.add_argument(
+    "-a",
+    "--annotations",
+    required=True,
+    type=str,
+    metavar="PATH",
+    help="path to annotations json file",
+)
+parser.add_argument("-n", "--num-images", default=10, type=int, metavar="N", help="number of images to compose")
+parser.add_argument("-r", "--repeat", default=5, type=int, metavar="N", help="number of passes over the images")
+parser.add_argument(
+    "-o",
+    "--output",
+    default="profile_output.prof",
+    type=str,
+    metavar="PATH",
+    help="path to profile output file",
+)
+
+
+def count_vertices(objects: list) -> int:
+    """Counts polygon vertices of the objects."""
+    polygons = [obj["segmentation"] for obj in objects if isinstance(obj["segmentation"], list)]
+    return sum(len(poly) // 2 for obj_polygons in polygons for poly in obj_polygons)
+
+
+def compose_all(data: Data, images: list, repeat: int):
+    """Decodes and composes every image, bypassing the viewer caches."""
+    for _ in range(repeat):
+        for image in images:
+            full_path, masks, bboxes, names_colors, mask_colors, _, _ = data.prepare_image(image=image)
+            img_open, scale = open_image(full_path)
+            compose_image(img_open, masks, bboxes, names_colors, mask_colors, scale=scale)
+
+
+def main():
+    args = parser.parse_args()
+    data = Data(args.images, args.annotations)
+
+    # Worst cases: images with the most polygon vertices
+    images = sorted(
+        data.images.image_list,
+        key=lambda image: count_vertices(data.ann_index.get(image[0], [])),
+        reverse=True,
+    )[: args.num_images]
+
+    profiler = cProfile.Profile()
+    profiler.runcall(compose_all, data, images, args.repeat)
+    profiler.dump_stats(args.output)
+
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+    print(f"Profile saved to {args.output}, view it with: snakeviz {args.output}")
+
+
+if __name__ == "__main__":
+    main()